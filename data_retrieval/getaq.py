@@ -1,20 +1,120 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from datetime import datetime, timezone
-from decimal import Decimal
-from typing import Tuple, Dict, cast
+from functools import lru_cache, partial
+from queue import Queue
+from threading import Event
+from typing import Any, Callable, Generator, IO, Iterator, List, Optional, Set, Tuple, Dict, Union
+import io
 import json
+import sys
 
 import requests
-import aqi  # type: ignore
+from requests.adapters import HTTPAdapter
+
+try:
+    import ijson  # type: ignore
+except ImportError:
+    ijson = None
+
+# Responses are only stream-parsed with ijson's C backend. Its pure-Python backend is tens of times slower than
+# reading the whole body and parsing it with json_loads.
+STREAM_PARSE = ijson is not None and ijson.backend == 'yajl2_c'
+
+# Serializes an object to a line of UTF-8 encoded JSON, including the trailing newline.
+json_line: Callable[[Any], bytes]
+json_loads: Callable[[bytes], Any]
+try:
+    from orjson import dumps, loads as json_loads, OPT_APPEND_NEWLINE
+    json_line = partial(dumps, option=OPT_APPEND_NEWLINE)
+except ImportError:
+    json_loads = json.loads
+
+    # Built once, rather than having json.dumps handle its arguments on every call. The options match orjson's output
+    # for finite numbers. Where orjson writes NaN and infinities as null, this raises ValueError instead; standard
+    # JSON, which is what the API sends, can't contain them.
+    json_encode = json.JSONEncoder(ensure_ascii=False, check_circular=False, allow_nan=False,
+                                   separators=(',', ':')).encode
+
+    def json_line(obj: Any) -> bytes:
+        """
+        Fallback for when orjson is unavailable.
+        :param obj: The object to serialize.
+        :return: The JSON document and a trailing newline, as bytes.
+        """
+        return (json_encode(obj) + '\n').encode('utf-8')
 
 API_URL = 'https://api.purpleair.com/v1/sensors'
 
+# Maximum number of tiles fetched at once, and the size of the connection pool that serves them.
+MAX_CONCURRENT_REQUESTS = 8
+
+# When fetching several tiles, readings are handed from the tiles' threads to the writing thread in chunks of this
+# many, so that the cost of the hand-off isn't paid per reading.
+READINGS_PER_CHUNK = 256
+
+# Maximum number of chunks waiting to be written, which bounds memory use when tiles are read faster than the output
+# is written.
+MAX_PENDING_CHUNKS = 16
+
+# Size of the write buffer for the JSON-lines output on STDOUT.
+OUTPUT_BUFFER_SIZE = 2 ** 16
+
 AllFieldsType = Tuple[str, str, str, str, str, str, str, str, str, str]
 # Record type is one longer than AllFieldsType, since an integer id is included first.
 RecordType = Tuple[int, int, str, int, int, float, float, int, float, float, float]
 
 FIELDS = ('name', 'private', 'last_seen', 'latitude', 'longitude', 'position_rating', 'pm1.0', 'pm2.5', 'pm10.0')
-ALL_FIELDS = cast(AllFieldsType, (['id'] + list(FIELDS)))
+ALL_FIELDS: AllFieldsType = ('id',) + FIELDS
+# The value of the API's fields query parameter.
+FIELDS_PARAM = ','.join(FIELDS)
+# Fields of the API response that are copied as-is into every reading.
+COMMON_FIELDS = ('api_version', 'location_type', 'max_age', 'firmware_default_version')
+
+# EPA breakpoints for PM 2.5 as (low concentration, high concentration, low IAQI, high IAQI), with concentrations
+# in µg/m³. From the EPA's Technical Assistance Document for the Reporting of Daily Air Quality (September 2018).
+PM25_BREAKPOINTS = (
+    (0.0, 12.0, 0, 50),
+    (12.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 150.4, 151, 200),
+    (150.5, 250.4, 201, 300),
+    (250.5, 350.4, 301, 400),
+    (350.5, 500.4, 401, 500)
+)
+
+
+def build_pm25_iaqi_table() -> Tuple[int, ...]:
+    """
+    Precompute the EPA IAQI for every PM 2.5 concentration from 0.0 to 500.4 in steps of 0.1, the precision at which
+    the EPA truncates PM 2.5 concentrations.
+    :return: A tuple whose item at index i is the IAQI for a concentration of i / 10 µg/m³.
+    """
+    table: List[int] = []
+    for c_lo, c_hi, i_lo, i_hi in PM25_BREAKPOINTS:
+        # Work in integer tenths so that the interpolation is exact until the final division.
+        lo, hi = round(c_lo * 10), round(c_hi * 10)
+        assert lo == len(table)
+        for c in range(lo, hi + 1):
+            # round() rounds half to even, as the EPA reference implementations do.
+            table.append(round((i_hi - i_lo) * (c - lo) / (hi - lo) + i_lo))
+    return tuple(table)
+
+
+PM25_IAQI_TABLE = build_pm25_iaqi_table()
+
+
+def positive_int(value: str) -> int:
+    """
+    An argparse type for integers of at least 1.
+    :param value: The command line argument.
+    :return: The argument as an integer.
+    """
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got %d' % n)
+    return n
 
 
 def parse_args() -> argparse.Namespace:
@@ -59,6 +159,13 @@ def parse_args() -> argparse.Namespace:
         help='Only get results from sensors updated in this past number of seconds.'
     )
 
+    parser.add_argument(
+        '--tiles',
+        type=positive_int,
+        default=1,
+        help='Split the bounding box into a grid of this many tiles on each side, and fetch the tiles concurrently.'
+    )
+
     parser.add_argument(
         '--keyfile',
         type=str,
@@ -76,6 +183,26 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
+@lru_cache(maxsize=None)
+def record_builder(fields: Tuple[str, ...]) -> Callable[[RecordType], Dict[str, Any]]:
+    """
+    Generate a function that turns a record into a dictionary keyed by `fields`. The generated function is a single
+    dict display indexing into the record, so unlike dict(zip(fields, record)) it creates no zip iterator per call.
+    :param fields: A string tuple of the names to use for the items in the record.
+    :return: A function taking a record and returning a dictionary with keys corresponding to those found in `fields`.
+    """
+    source = 'def build(record):\n    return {%s}\n' % ', '.join(
+        '%r: record[%d]' % (k, i) for i, k in enumerate(fields)
+    )
+    namespace: Dict[str, Any] = {}
+    exec(source, namespace)
+    return namespace['build']
+
+
+# Bound once, so that records with the usual fields skip record_builder's cache lookup, which hashes the whole tuple.
+build_all_fields = record_builder(ALL_FIELDS)
+
+
 def parse_sensor_record(fields: AllFieldsType, record: RecordType) -> Dict:
     """
     Takes a sensor's record from the PurpleAir API, calculates the EPA IAQI for PM 2.5, and returns a dictionary.
@@ -86,19 +213,28 @@ def parse_sensor_record(fields: AllFieldsType, record: RecordType) -> Dict:
     :return: A dictionary with keys corresponding to those found in `fields`, plus key epa_iaqi_25.
     """
     assert len(fields) == len(record)
-    stats = {k: v for k, v in zip(fields, record)}
+    build = build_all_fields if fields is ALL_FIELDS else record_builder(fields)
+    stats = build(record)
 
-    assert isinstance(stats['pm2.5'], float)
-    if stats['pm2.5'] <= 500:
-        stats['epa_iaqi_25'] = aqi.to_iaqi(aqi.POLLUTANT_PM25, str(stats['pm2.5']), algo=aqi.ALGO_EPA)
-        assert isinstance(stats['epa_iaqi_25'], Decimal)
-        stats['epa_iaqi_25'] = int(stats['epa_iaqi_25'])
-    else:
-        # EPA AQI is undefined for pm2.5 > 500.
-        stats['epa_iaqi_25'] = None
+    stats['epa_iaqi_25'] = pm25_iaqi(stats['pm2.5'])
     return stats
 
 
+def pm25_iaqi(c: float) -> Optional[int]:
+    """
+    Calculate the EPA IAQI for a PM 2.5 concentration by looking it up in PM25_IAQI_TABLE.
+    :param c: A PM 2.5 concentration in µg/m³.
+    :return: The IAQI, or None if the concentration is outside the range 0 to 500 for which the EPA defines it.
+    """
+    if not 0 <= c <= 500:
+        return None
+    # The EPA truncates to tenths. The small offset stops binary float error from truncating a step too far, e.g.
+    # 2.3 * 10 == 22.999999999999996.
+    return PM25_IAQI_TABLE[int(c * 10 + 1e-9)]
+
+
+# Sensors commonly report the same last_seen time within a polling window, so conversions repeat often.
+@lru_cache(maxsize=1024)
 def iso_date(d: float) -> str:
     """
     Convert a float timestamp to an ISO 8601 format string in UTC.
@@ -108,7 +244,208 @@ def iso_date(d: float) -> str:
     return datetime.fromtimestamp(d, tz=timezone.utc).isoformat()
 
 
-def main() -> None:
+def split_bbox(nwlat: float, nwlng: float, selat: float, selng: float,
+               n: int) -> List[Tuple[float, float, float, float]]:
+    """
+    Split a bounding box into an n by n grid of smaller bounding boxes.
+    :param nwlat: The northwest bounding box latitude.
+    :param nwlng: The northwest bounding box longitude.
+    :param selat: The southeast bounding box latitude.
+    :param selng: The southeast bounding box longitude.
+    :param n: The number of tiles on each side of the grid.
+    :return: A list of (nwlat, nwlng, selat, selng) tuples, one per tile.
+    """
+    lat_step = (nwlat - selat) / n
+    lng_step = (selng - nwlng) / n
+    return [
+        (nwlat - i * lat_step, nwlng + j * lng_step, nwlat - (i + 1) * lat_step, nwlng + (j + 1) * lng_step)
+        for i in range(n)
+        for j in range(n)
+    ]
+
+
+def read_tile(session: requests.Session, params: Dict,
+              headers: Dict) -> Generator[Tuple[int, bytes], None, None]:
+    """
+    Fetch and parse the API data for a single bounding box, yielding each reading as it is parsed. The response is
+    closed when the generator finishes or is closed, so a tile holds a connection only while it is being read.
+    :param session: The requests session to fetch with.
+    :param params: The query parameters, including the bounding box.
+    :param headers: The request headers.
+    :return: A generator of (sensor id, JSON line) tuples, one per reading.
+    """
+    with session.get(API_URL, params=params, headers=headers, stream=True) as r:
+        # Have reads from r.raw undo any gzip or deflate content encoding.
+        r.raw.decode_content = True
+        data, sensor_records = stream_response(r.raw)
+
+        # These fields describe the whole response, so they're the same for every reading.
+        common = {k: data[k] for k in COMMON_FIELDS}
+        common['time_stamp'] = iso_date(data['time_stamp'])
+        common['data_time_stamp'] = iso_date(data['data_time_stamp'])
+
+        for sensor_record in sensor_records:
+            parsed = parse_sensor_record(ALL_FIELDS, sensor_record)
+            parsed.update(common)
+            parsed['last_seen'] = iso_date(parsed['last_seen'])
+
+            yield sensor_record[0], json_line(parsed)
+
+
+TileResult = Union[List[Tuple[int, bytes]], Exception, None]
+
+
+def queue_tile(session: requests.Session, params: Dict, headers: Dict, results: 'Queue[TileResult]',
+               stop: Event) -> None:
+    """
+    Read a single bounding box with read_tile(), putting its readings on `results` in chunks of READINGS_PER_CHUNK.
+    :param session: The requests session to fetch with.
+    :param params: The query parameters, including the bounding box.
+    :param headers: The request headers.
+    :param results: Receives lists of (sensor id, JSON line) tuples, then any exception raised, then None once the
+    tile is finished.
+    :param stop: When set, the tile is abandoned without fetching or parsing any further.
+    """
+    try:
+        if stop.is_set():
+            return
+
+        with closing(read_tile(session, params, headers)) as readings:
+            chunk = []
+            for reading in readings:
+                chunk.append(reading)
+                if len(chunk) == READINGS_PER_CHUNK:
+                    if stop.is_set():
+                        return
+                    results.put(chunk)
+                    chunk = []
+            if chunk:
+                results.put(chunk)
+    except Exception as e:
+        results.put(e)
+    finally:
+        results.put(None)
+
+
+class ReplayReader:
+    """
+    Wraps a binary file, recording what is read from it until rewind() is called. Reads after that first replay the
+    recorded bytes, then carry on with the rest of the file.
+    """
+
+    def __init__(self, fp: IO[bytes]) -> None:
+        self.fp = fp
+        self.recorded: List[bytes] = []
+        self.recording = True
+        self.replay = b''
+
+    def read(self, n: int = -1) -> bytes:
+        if self.replay:
+            if n < 0:
+                n = len(self.replay)
+            chunk, self.replay = self.replay[:n], self.replay[n:]
+            return chunk
+
+        chunk = self.fp.read(n)
+        if self.recording:
+            self.recorded.append(chunk)
+        return chunk
+
+    def rewind(self) -> None:
+        self.replay = b''.join(self.recorded)
+        self.recorded = []
+        self.recording = False
+
+
+def stream_response(fp: IO[bytes]) -> Tuple[Dict, Iterator[RecordType]]:
+    """
+    Incrementally parse an API response, so that sensor records can be handled as they arrive instead of after the
+    whole body has been read and decoded. This relies on the API sending its response-wide fields before the data
+    array, which it does. Without ijson's C backend, the whole body is read and parsed at once instead.
+    :param fp: The response body.
+    :return: A tuple of a dictionary of the response's top-level fields, such as api_version and time_stamp, and an
+    iterator over the sensor records in the data array.
+    """
+    if not STREAM_PARSE:
+        data = json_loads(fp.read())
+        return data, iter(data['data'])
+
+    reader = ReplayReader(fp)
+
+    header: Dict = {}
+    for prefix, event, value in ijson.parse(reader, use_float=True):
+        if prefix == 'data' and event == 'start_array':
+            break
+        # Nested prefixes contain a dot, e.g. fields.item.
+        if prefix and '.' not in prefix and event in ('string', 'number', 'boolean', 'null'):
+            header[prefix] = value
+
+    # Parse again from the start, replaying the little that was read for the header. Handing ijson.items the file,
+    # rather than the events above, keeps the whole parse in C, which takes about a third of the time.
+    reader.rewind()
+    return header, ijson.items(reader, 'data.item', use_float=True)
+
+
+@contextmanager
+def stdout_writer() -> Iterator[Callable[[bytes], Any]]:
+    """
+    Provide a function that writes bytes to STDOUT. When STDOUT has a file descriptor, the bytes go through a writer
+    with a buffer of OUTPUT_BUFFER_SIZE on that descriptor. Otherwise, such as under contextlib.redirect_stdout, they
+    are written through sys.stdout itself.
+    :return: A context manager yielding the write function, which flushes any buffered output on exit.
+    """
+    # Anything already written to sys.stdout must come out before our output does.
+    sys.stdout.flush()
+
+    fd: Optional[int]
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fd = None
+
+    if fd is not None:
+        # closefd=False leaves STDOUT itself open when the buffered writer is closed.
+        with open(fd, 'wb', buffering=OUTPUT_BUFFER_SIZE, closefd=False) as out:
+            yield out.write
+        return
+
+    buffer = getattr(sys.stdout, 'buffer', None)
+    try:
+        if buffer is not None:
+            yield buffer.write
+        else:
+            yield lambda b: sys.stdout.write(b.decode('utf-8'))
+    finally:
+        if buffer is not None:
+            buffer.flush()
+
+
+def make_session() -> requests.Session:
+    """
+    Create a requests session whose connections to the API are kept alive and reused between requests.
+    :return: A requests session.
+    """
+    session = requests.Session()
+    # requests asks for 'gzip, deflate' by default, adding 'br' when the brotli package is installed to decode it.
+    # Advertising 'br' without brotli installed would leave responses undecodable, so the header is left as is.
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_REQUESTS,
+                                              pool_block=True))
+    return session
+
+
+# The session used by main() when none is passed in.
+_SESSION = make_session()
+
+
+def main(session: Optional[requests.Session] = None) -> None:
+    """
+    Fetch the API data for the region given on the command line and write the readings to STDOUT.
+    :param session: The requests session to fetch with. When calling main() repeatedly, pass the same session to reuse
+    its connections. Defaults to a module-level session.
+    """
+    if session is None:
+        session = _SESSION
+
     args = parse_args()
 
     if args.apikey is not None:
@@ -119,38 +456,60 @@ def main() -> None:
 
     headers = {'X-API-Key': apikey}
 
-    params = {
-        'fields': ','.join(FIELDS),
-        'location_type': 0,  # Outside
-        'max_age': args.maxage,
-        'nwlat': args.nwlat,
-        'nwlng': args.nwlng,
-        'selat': args.selat,
-        'selng': args.selng
-    }
-
-    r = requests.get(
-        API_URL,
-        params=params,
-        headers=headers
-    )
-
-    data = r.json()
-
-    readings = []
-    for sensor_record in data['data']:
-        parsed = parse_sensor_record(ALL_FIELDS, sensor_record)
-
-        for plain_key in ['api_version', 'location_type', 'max_age', 'firmware_default_version']:
-            parsed[plain_key] = data[plain_key]
-
-        parsed['time_stamp'] = iso_date(data['time_stamp'])
-        parsed['data_time_stamp'] = iso_date(data['data_time_stamp'])
-        parsed['last_seen'] = iso_date(parsed['last_seen'])
-
-        readings.append(parsed)
-
-    print('\n'.join([json.dumps(reading) for reading in readings]))
+    tile_params = [
+        {
+            'fields': FIELDS_PARAM,
+            'location_type': 0,  # Outside
+            'max_age': args.maxage,
+            'nwlat': nwlat,
+            'nwlng': nwlng,
+            'selat': selat,
+            'selng': selng
+        }
+        for nwlat, nwlng, selat, selng in split_bbox(args.nwlat, args.nwlng, args.selat, args.selng, args.tiles)
+    ]
+
+    with stdout_writer() as write:
+        if len(tile_params) == 1:
+            # Read a single tile on this thread, rather than handing its readings over from another one.
+            with closing(read_tile(session, tile_params[0], headers)) as readings:
+                for _, line in readings:
+                    write(line)
+            return
+
+        results: 'Queue[TileResult]' = Queue(maxsize=MAX_PENDING_CHUNKS)
+        stop = Event()
+        remaining = len(tile_params)
+
+        # A sensor lying on the edge between two tiles may be returned for both.
+        seen_ids: Set[int] = set()
+
+        # Each tile is read on its own thread. Readings are written as soon as any tile has parsed them, rather than
+        # holding every reading in memory or waiting for the slowest tile.
+        with ThreadPoolExecutor(max_workers=min(len(tile_params), MAX_CONCURRENT_REQUESTS)) as executor:
+            for params in tile_params:
+                executor.submit(queue_tile, session, params, headers, results, stop)
+
+            try:
+                while remaining:
+                    result = results.get()
+                    if result is None:
+                        remaining -= 1
+                    elif isinstance(result, Exception):
+                        raise result
+                    else:
+                        for sensor_id, line in result:
+                            if sensor_id in seen_ids:
+                                continue
+                            seen_ids.add(sensor_id)
+                            write(line)
+            finally:
+                # When leaving early, stop the other tiles and wait for them to close their responses. Draining the
+                # queue keeps them from blocking on a full queue.
+                stop.set()
+                while remaining:
+                    if results.get() is None:
+                        remaining -= 1
 
 
 if __name__ == '__main__':